@@ -0,0 +1,46 @@
+from types import MappingProxyType
+
+# OAuth scope requested for the Vertex AI service account
+VERTEX_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+# Alpaca prompt template the model was fine-tuned on
+ALPACA_PROMPT = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+
+    ### Instruction:
+    {instruction}
+
+    ### Input:
+    {input_text}
+
+    ### Response:
+    """
+
+# Caption category shown in the selector -> instruction sent to the model
+INSTRUCTION_CATEGORIES = MappingProxyType({
+    "Tip me": "Generate a Tip Me Caption",
+    "Winner": "Generate a Winner Caption",
+    "Holiday": "Generate a Holiday Caption",
+    "Bundle": "Generate a Bundle Caption",
+    "Descriptive": "Generate a Descriptive Caption",
+    "Spin the Wheel": "Generate a Spin the Wheel Caption",
+    "Girlfriend": "Generate a Girlfriend Caption",
+    "List": "Generate a List Caption",
+    "Short": "Generate a Short Caption",
+    "Sub Promo": "Generate a Sub Promo Caption",
+    "VIP": "Generate a VIP Caption",
+})
+
+# Generation settings applied by the sidebar template buttons; a new session
+# starts from the "Default" template
+SETTINGS_TEMPLATES = MappingProxyType({
+    "Default": MappingProxyType({
+        "num_captions": 1, "max_tokens": 1024, "temperature": 0.90, "top_k": 50, "top_p": 0.90,
+    }),
+    "Template 2": MappingProxyType({
+        "num_captions": 1, "max_tokens": 1024, "temperature": 1.20, "top_k": 80, "top_p": 0.40,
+    }),
+    "Template 3": MappingProxyType({
+        "num_captions": 1, "max_tokens": 1024, "temperature": 1.30, "top_k": 90, "top_p": 0.50,
+    }),
+})
+DEFAULT_SETTINGS = SETTINGS_TEMPLATES["Default"]
@@ -1,24 +1,94 @@
 import streamlit as st
 import pandas as pd
 import os
-import requests
-import json
-from google.auth.transport.requests import Request
-from google.oauth2 import service_account
-from dotenv import load_dotenv 
+import datetime
+import hashlib
+import hmac
+import functools
+import io
+import logging
+import queue
+import re
+import secrets
+import threading
+import time
+import orjson
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+from dotenv import load_dotenv
 import streamlit.components.v1 as components
+from constants import (
+    ALPACA_PROMPT, DEFAULT_SETTINGS, INSTRUCTION_CATEGORIES, SETTINGS_TEMPLATES, VERTEX_SCOPE
+)
 import pandas as pd
 
-load_dotenv() 
+if TYPE_CHECKING:
+    import requests
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Default number of caption requests in flight against the endpoint at once;
+# deployments can override it with endpoints.MAX_CONCURRENT_REQUESTS in secrets
+MAX_CONCURRENT_REQUESTS = 5
+
+# Default number of captions sampled per request with the chat completions "n"
+# parameter; set endpoints.CAPTIONS_PER_REQUEST in secrets if the server supports n > 1
+CAPTIONS_PER_REQUEST = 1
+
+# (connect, read) timeouts in seconds for each caption request
+REQUEST_TIMEOUT = (3, 60)
+
+# Upper bound in seconds on the time spent streaming a single caption
+STREAM_DEADLINE = 300
+
+# Statuses returned when the endpoint quota is exhausted, it is overloaded or a
+# gateway in front of it fails; requests that get them are retried with backoff
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Most requests made for a caption before giving up on one free of banned words
+MAX_CAPTION_ATTEMPTS = 5
+
+# Minimum seconds between re-renders of a caption while it streams
+RENDER_INTERVAL = 0.05
+
+# Refresh the access token when it is this close to expiring
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Start refreshing the access token in the background when it is this close to expiring
+TOKEN_STALE_MARGIN = datetime.timedelta(minutes=10)
 
 # --- Authentication Functions ---
+def hash_password(password, salt):
+    """Return the SHA-256 hex digest stored in secrets for a salted password"""
+    return hashlib.sha256((salt + password).encode()).hexdigest()
+
+@st.cache_resource
+def get_authorized_users():
+    """Salt and password digest for every authorized user, read from secrets once per process"""
+    users = {}
+    for username, record in st.secrets.authorized_users.items():
+        # Plain-text entries are still accepted until they are migrated to {salt, hash};
+        # hashing them here under a fresh salt lets every login take the same path
+        if isinstance(record, str):
+            salt = secrets.token_hex(16)
+            users[username] = (salt, hash_password(record, salt).encode())
+        else:
+            users[username] = (record["salt"], record["hash"].encode())
+    return users
+
 def check_credentials(username, password):
     """Check if username/password combination exists in authorized users"""
     try:
         # Check if username exists and password matches
-        if username in st.secrets.authorized_users:
-            return st.secrets.authorized_users[username] == password
-        return False
+        user = get_authorized_users().get(username)
+        if user is None:
+            return False
+        salt, digest = user
+        return hmac.compare_digest(digest, hash_password(password, salt).encode())
     except Exception as e:
         st.error(f"Error in authentication")
         return False
@@ -45,25 +115,180 @@ def login_page():
         return False
     return True
 
-def initialize_api_credentials():
-    """Initialize API credentials after successful login"""
-    # Define the required scope
-    scope = "https://www.googleapis.com/auth/cloud-platform"
+@st.cache_resource
+def get_vertex_credentials():
+    """Load the service account credentials once per process"""
+    # google-auth is imported here so the login page renders without paying for it
+    from google.oauth2 import service_account
+
     service_account_info = st.secrets["credentials"]
 
-    # Load the service account credentials
-    vertex_credentials = service_account.Credentials.from_service_account_info(
-        service_account_info, scopes=[scope]
+    return service_account.Credentials.from_service_account_info(
+        service_account_info, scopes=[VERTEX_SCOPE]
     )
 
-    # Refresh the credentials to get an access token
-    vertex_credentials.refresh(Request())
+@st.cache_resource
+def get_token_lock():
+    """Lock serializing token refreshes of the shared credentials across sessions"""
+    return threading.Lock()
+
+@st.cache_resource
+def get_token_refresh_failed():
+    """Set when a background token refresh fails, so the next call refreshes in the foreground"""
+    return threading.Event()
+
+def token_expires_soon(credentials, margin=TOKEN_REFRESH_MARGIN):
+    """Check whether the credentials' token expires within `margin`"""
+    if credentials.expiry is None:
+        return False
+    # google-auth stores expiry as a naive UTC datetime
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return credentials.expiry - now < margin
+
+def refresh_token_in_background(credentials, lock, failed):
+    """
+    Refresh the token on a daemon thread, unless a refresh is already under way.
+
+    A failure is logged and sets `failed`, so the next get_access_token call
+    refreshes in the foreground and reports the error to the user.
+    """
+    if not lock.acquire(blocking=False):
+        return
+
+    def refresh():
+        from google.auth.transport.requests import Request
+
+        try:
+            credentials.refresh(Request())
+            failed.clear()
+        except Exception:
+            logger.exception("Background access token refresh failed")
+            failed.set()
+        finally:
+            lock.release()
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+def get_access_token():
+    """Return a valid API access token, refreshing the cached credentials only when needed"""
+    from google.auth.transport.requests import Request
+
+    vertex_credentials = get_vertex_credentials()
+    refresh_failed = get_token_refresh_failed()
+
+    def needs_refresh():
+        # A failed background refresh is retried here, where its error reaches the user
+        return (
+            refresh_failed.is_set()
+            or not vertex_credentials.valid
+            or token_expires_soon(vertex_credentials)
+        )
+
+    # Tokens live for about an hour, so most calls reuse the current one. Refreshing
+    # a few minutes early keeps a token from expiring during a long generation run.
+    if needs_refresh():
+        # Sessions share the credentials, so only the first one to find the token
+        # stale refreshes it; the others wait and then reuse the new token
+        with get_token_lock():
+            if needs_refresh():
+                vertex_credentials.refresh(Request())
+                refresh_failed.clear()
+    elif token_expires_soon(vertex_credentials, TOKEN_STALE_MARGIN):
+        # Still usable for a while: hand out the current token and renew it off
+        # the script thread, so no click has to wait on the token endpoint
+        refresh_token_in_background(vertex_credentials, get_token_lock(), refresh_failed)
     return vertex_credentials.token
 
+@st.cache_resource
+def get_http_session():
+    """Shared HTTP session so connections to the endpoint are kept alive and reused"""
+    # Imported on first use so the login page renders without loading the HTTP stack
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    # Keep enough pooled connections for every concurrent caption request
+    pool_size = max(16, get_max_concurrent_requests())
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=pool_size,
+        # Only failed connections and RETRY_STATUSES are retried. POST is excluded by
+        # default, but a request answered with one of those statuses was never started,
+        # so it is safe to send again. Read errors are not retried: the server may
+        # already be generating, and REQUEST_TIMEOUT must stay the bound on a stalled
+        # stream. Backoff is 0, 2, 4 and 8 seconds, and Retry-After is ignored so a
+        # server cannot stretch the wait beyond that.
+        max_retries=Retry(
+            total=4,
+            connect=2,
+            read=0,
+            other=0,
+            backoff_factor=1,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    return session
+
+class CaptionCache:
+    """Thread-safe LRU of finished captions, keyed on the seeded request body that produced them"""
+
+    def __init__(self, max_entries=128):
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            caption = self._entries.get(key)
+            if caption is not None:
+                self._entries.move_to_end(key)
+            return caption
+
+    def put(self, key, caption):
+        with self._lock:
+            self._entries[key] = caption
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+@dataclass(frozen=True, slots=True)
+class HistoryEntry:
+    """One generation run as listed on the history page"""
+    instruction: str
+    context: str
+    captions: tuple[str, ...]
+    temperature: float
+    top_k: int
+    top_p: float
+
+    @property
+    def settings(self):
+        """Sampling settings restored by Load Parameters Used"""
+        return {"temperature": self.temperature, "top_k": self.top_k, "top_p": self.top_p}
+
+@st.cache_resource
+def get_caption_cache():
+    """Caption cache shared by every session in this process"""
+    return CaptionCache()
+
 # --- Load External CSS ---
-def load_css(file_name):
+@st.cache_data
+def read_css(file_name, mtime):
+    """Read and minify a stylesheet once per modification time"""
     with open(file_name) as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
+        css = f.read()
+    # Drop comments and collapse whitespace to shrink the page payload
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    return re.sub(r"\s+", " ", css).strip()
+
+def load_css(file_name):
+    css = read_css(file_name, os.path.getmtime(file_name))
+    st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
 
 def initialize_session_state():
     """Initialize all session state variables with default values"""
@@ -73,67 +298,50 @@ def initialize_session_state():
         "generated_captions": [],
         "current_captions": [],
         "caption_history": [],
-        "num_captions": 1,
-        "max_length": 1024,
-        "temperature": 0.90,
-        "top_k": 50,
-        "top_p": 0.90,
+        **DEFAULT_SETTINGS,
+        "seed": None,
         "pending_settings": None,
         "settings_updated": False,
         "is_generating": False,
-        "instruction_categories": {
-            "Tip me": "Generate a Tip Me Caption",
-            "Winner": "Generate a Winner Caption",
-            "Holiday": "Generate a Holiday Caption",
-            "Bundle": "Generate a Bundle Caption",
-            "Descriptive": "Generate a Descriptive Caption",
-            "Spin the Wheel": "Generate a Spin the Wheel Caption",
-            "Girlfriend": "Generate a Girlfriend Caption",
-            "List": "Generate a List Caption",
-            "Short": "Generate a Short Caption",
-            "Sub Promo": "Generate a Sub Promo Caption",
-            "VIP": "Generate a VIP Caption"
-        }
     }
     
     # Only set defaults if they don't exist in session state
     for key, value in defaults.items():
-        if key not in st.session_state:
-            st.session_state[key] = value
+        st.session_state.setdefault(key, value)
 
 def add_logout_button():
     """Add a logout button to the bottom of the sidebar"""
-    # Create empty space to push the button to the bottom
-    st.sidebar.markdown('<div style="height: 0vh;"></div>', unsafe_allow_html=True)
     if st.sidebar.button("Logout"):
-        for key in st.session_state.keys():
-            del st.session_state[key]
+        st.session_state.clear()
         st.rerun()
 
-def show_generation_page(access_token):
+def show_generation_page():
     """Display the main caption generation page"""
     st.markdown(
         "<h1 style='text-align: center;'>Tasty Caption Generation 🫦</h1>",
         unsafe_allow_html=True
     )
+    # Every read through the session state proxy goes through Streamlit's
+    # attribute lookup, so bind it once and read each setting a single time
+    state = st.session_state
     
     # Welcome message
-    st.markdown(f"Welcome, {st.session_state.username}!")
+    st.markdown(f"Welcome, {state.username}!")
     
     # Show success message if settings were updated
-    if st.session_state.get('settings_updated', False):
+    if state.get('settings_updated', False):
         st.success("Settings updated successfully!")
-        st.session_state.settings_updated = False
+        state.settings_updated = False
     
     # Replace text input with dropdown
     selected_category = st.selectbox(
         "Select Caption Category:",
-        options=list(st.session_state.instruction_categories.keys()),
-        disabled=st.session_state.is_generating
+        options=list(INSTRUCTION_CATEGORIES.keys()),
+        disabled=state.is_generating
     )
     
     # Get the corresponding instruction
-    instruction = st.session_state.instruction_categories[selected_category]
+    instruction = INSTRUCTION_CATEGORIES[selected_category]
     banned_words_list = access_banned_words_list()
     # Display the actual instruction that will be used (optional - you can remove this if you don't want to show it)
     st.caption(f"Using instruction: *{instruction}*")
@@ -141,16 +349,16 @@ def show_generation_page(access_token):
     input_text = st.text_area(
         "Enter Context:", 
         placeholder="Describe the Caption",
-        disabled=st.session_state.is_generating
+        disabled=state.is_generating
     )
     
     # Create a placeholder for captions
     caption_placeholder = st.empty()
     
     # Display existing captions if they exist
-    if 'current_captions' in st.session_state and st.session_state.current_captions:
+    if 'current_captions' in state and state.current_captions:
         caption_text = ""
-        for idx, caption in enumerate(st.session_state.current_captions):
+        for idx, caption in enumerate(state.current_captions):
             caption_text += f"**Caption {idx + 1}:** {caption}\n\n"
         caption_placeholder.markdown(caption_text)
     
@@ -160,54 +368,190 @@ def show_generation_page(access_token):
             st.error(error_message)
         else:
             # Clear previous captions
-            st.session_state.current_captions = []
-            
-            # Generate captions
-            for i in range(st.session_state["num_captions"]):
-                with st.spinner(f"Generating caption {i + 1}..."):
-                    valid_caption = False  # Flag to check if the generated caption is valid
-                    while not valid_caption:
-                        response = generate_caption_from_api(
-                            instruction,
-                            input_text,
-                            st.session_state["max_length"],
-                            st.session_state["temperature"],
-                            st.session_state["top_k"],
-                            st.session_state["top_p"],
-                            access_token,
-                        )
-                        
-                        # Check if the response contains any banned words
-                        if response:
-                            words_in_response = response.lower().split()
-                            if not any(banned_word in words_in_response for banned_word in banned_words_list):
-                                valid_caption = True  # Caption is valid if no banned words are found
-                            else:
-                                st.warning(f"Generated caption contains banned words. Retrying...")
-                    
-                    # Append the valid caption to the session state
-                    st.session_state.current_captions.append(response)
-                    
-                    # Update the captions displayed
-                    caption_text = ""
-                    for idx, caption in enumerate(st.session_state.current_captions):
-                        caption_text += f"**Caption {idx + 1}:** {caption}\n\n"
-                    caption_placeholder.markdown(caption_text)
-            
+            state.current_captions = []
+            # Read the settings once for the whole run
+            num_captions = state.num_captions
+            max_tokens = state.max_tokens
+            temperature = state.temperature
+            top_k = state.top_k
+            top_p = state.top_p
+            seed = state.seed
+            if temperature == 0 and num_captions > 1:
+                # Greedy decoding returns the same text on every request, seeded or not
+                st.info("A temperature of 0 always produces the same caption, so only one is generated.")
+                num_captions = 1
+            captions = [None] * num_captions
+            partials = [io.StringIO() for _ in range(num_captions)]
+            caption_cache = get_caption_cache()
+            cache_keys = {}  # Caption index -> (seeded request body, choice position) it is cached under
+
+            # One placeholder per caption, so a delta only re-renders its own caption
+            with caption_placeholder.container():
+                caption_slots = [st.empty() for _ in range(num_captions)]
+            last_rendered = [0.0] * num_captions
+
+            def render_caption(idx):
+                """Update the displayed text of one caption"""
+                caption_slots[idx].markdown(f"**Caption {idx + 1}:** {partials[idx].getvalue()}")
+                last_rendered[idx] = time.monotonic()
+
+            def on_delta(idx, delta):
+                """Show streamed text as it arrives, at most once per RENDER_INTERVAL per caption"""
+                if delta is None:
+                    partials[idx] = io.StringIO()  # Rejected caption is being regenerated
+                    caption_slots[idx].empty()
+                    return
+                partials[idx].write(delta)
+                if time.monotonic() - last_rendered[idx] >= RENDER_INTERVAL:
+                    render_caption(idx)
+
+            def on_caption(idx, caption, rejected):
+                """Store and show a finished caption"""
+                if caption is None:
+                    if rejected:
+                        st.error(f"Caption {idx + 1} could not be generated without banned words and was dropped.")
+                    else:
+                        st.error(f"Caption {idx + 1} was dropped because the endpoint returned no text.")
+                    caption_slots[idx].empty()
+                    return
+                captions[idx] = caption
+                partials[idx] = io.StringIO(caption)
+                if idx in cache_keys:
+                    caption_cache.put(cache_keys[idx], caption)
+                if rejected:
+                    st.warning(f"Caption {idx + 1} contained banned words and was regenerated {rejected} time(s).")
+                render_caption(idx)
+
+            request_settings = (
+                instruction,
+                input_text,
+                max_tokens,
+                temperature,
+                top_p,
+            )
+            # Only fetch a token when a generation is actually requested
+            url = get_endpoint_url()
+            headers = build_request_headers(get_access_token())
+            # Cached resources are resolved here, on the script thread, for the workers
+            session = get_http_session()
+
+            # Group captions into batches that are sampled by a single request
+            batch_size = get_captions_per_request()
+            batches = [
+                list(range(start, min(start + batch_size, num_captions)))
+                for start in range(0, num_captions, batch_size)
+            ]
+
+            # Only seeded or greedy (temperature 0) sampling is reproducible enough to cache
+            cacheable = seed is not None or temperature == 0
+
+            if not cacheable:
+                # Every batch shares the same request, so build it once
+                make_body = make_request_bodies(request_settings)
+                jobs = [(slots, make_body) for slots in batches]
+            else:
+                # Reproducible captions are served from the cache on repeats
+                jobs = []
+                for slots in batches:
+                    batch_seed = None if seed is None else seed + slots[0]
+                    make_body = make_request_bodies(request_settings, batch_seed, num_captions)
+                    key = make_body(len(slots), 0)
+                    cached = [caption_cache.get((key, position)) for position in range(len(slots))]
+                    if None not in cached:
+                        for idx, caption in zip(slots, cached):
+                            on_caption(idx, caption, 0)
+                    else:
+                        for position, idx in enumerate(slots):
+                            cache_keys[idx] = (key, position)
+                        jobs.append((slots, make_body))
+
+            # Generate captions concurrently
+            if jobs:
+                pending_count = sum(len(slots) for slots, _ in jobs)
+                # Clicking Stop reruns the script, which interrupts this run and
+                # cancels the caption requests still in flight
+                st.button("Stop", key="stop_generation")
+                # Clearing an empty placeholder changes nothing on the page, but as a
+                # Streamlit call it lets a pending Stop or rerun interrupt the wait
+                heartbeat = st.empty()
+                with st.spinner(f"Generating {pending_count} caption(s)..."):
+                    generate_captions_concurrently(
+                        jobs,
+                        on_delta,
+                        on_caption,
+                        heartbeat.empty,
+                        session,
+                        url,
+                        headers,
+                        banned_words_list,
+                        get_max_concurrent_requests(),
+                        # A greedy retry would only repeat the rejected caption
+                        max_attempts=1 if temperature == 0 else MAX_CAPTION_ATTEMPTS,
+                    )
+
+            captions = [caption for caption in captions if caption is not None]
+            state.current_captions = captions
+
             # After generation is complete, add to history
-            if st.session_state.current_captions:
-                history_entry = {
-                    "instruction": instruction,
-                    "context": input_text,
-                    "captions": st.session_state.current_captions.copy(),
-                    "settings": {
-                        "temperature": st.session_state.temperature,
-                        "top_k": st.session_state.top_k,
-                        "top_p": st.session_state.top_p
-                    }
-                }
+            if captions:
+                history_entry = HistoryEntry(
+                    instruction=instruction,
+                    context=input_text,
+                    captions=tuple(captions),
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                )
                 # Add new entry to the beginning of the history
-                st.session_state.caption_history.insert(0, history_entry)
+                state.caption_history.insert(0, history_entry)
+
+@st.cache_data
+def captions_to_excel(captions: tuple[str, ...]) -> bytes:
+    """Serialize captions to an Excel workbook in memory, once per set of captions"""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        pd.DataFrame({"Captions": captions}).to_excel(writer, index=False)
+    return buffer.getvalue()
+
+@st.fragment
+def show_history_entry(entry, display_num, expanded):
+    """
+    Display one generation in the history.
+
+    Runs as a fragment, so its buttons rerun only this entry rather than the whole
+    history list; loading its parameters still reruns the full app.
+    """
+    with st.expander(f"Generation {display_num}", expanded=expanded):
+        # Render the whole entry as a single element
+        captions_text = "\n\n".join(
+            f"*Caption {i + 1}:* {caption}" for i, caption in enumerate(entry.captions)
+        )
+        st.markdown(
+            f"**Instruction:**\n\n{entry.instruction}\n\n"
+            f"**Context:**\n\n{entry.context}\n\n"
+            f"**Settings:**\n\n"
+            f"- Temperature: {entry.temperature}\n"
+            f"- Top-k: {entry.top_k}\n"
+            f"- Top-p: {entry.top_p}\n\n"
+            f"**Generated Captions:**\n\n{captions_text}"
+        )
+        
+        # Button to load parameters used
+        if st.button("Load Parameters Used", key=f"use_settings_{display_num}"):
+            # Store the settings we want to apply
+            st.session_state.pending_settings = entry.settings
+            st.session_state.show_history = False
+            st.session_state.settings_updated = True
+            st.rerun()
+        
+        # Button to export captions to Excel
+        st.download_button(
+            label="Export to Excel",
+            data=lambda captions=entry.captions: captions_to_excel(captions),
+            file_name="generated_captions.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key=f"download_excel_{display_num}"
+        )
 
 def show_history_page():
     """Display the history page"""
@@ -223,44 +567,73 @@ def show_history_page():
         for idx, entry in enumerate(st.session_state.caption_history):
             display_num = total_entries - idx
             
-            with st.expander(f"Generation {display_num}", expanded=(idx == 0)):
-                st.write("**Instruction:**")
-                st.write(entry["instruction"])
-                st.write("**Context:**")
-                st.write(entry["context"])
-                st.write("**Settings:**")
-                st.write(f"- Temperature: {entry['settings']['temperature']}")
-                st.write(f"- Top-k: {entry['settings']['top_k']}")
-                st.write(f"- Top-p: {entry['settings']['top_p']}")
-                st.write("**Generated Captions:**")
-                for i, caption in enumerate(entry["captions"]):
-                    st.write(f"*Caption {i + 1}:* {caption}")
-                
-                # Button to load parameters used
-                if st.button("Load Parameters Used", key=f"use_settings_{display_num}"):
-                    # Store the settings we want to apply
-                    st.session_state.pending_settings = entry["settings"]
-                    st.session_state.show_history = False
-                    st.session_state.settings_updated = True
-                    st.rerun()
-                
-                # Button to export captions to Excel
-                if st.button("Export to Excel", key=f"export_to_excel_{display_num}"):
-                    # Create a DataFrame from the captions
-                    df = pd.DataFrame({"Captions": entry["captions"]})
-                    # Save the DataFrame to an Excel file
-                    excel_file = "generated_captions.xlsx"
-                    df.to_excel(excel_file, index=False)
-                    
-                    # Download the Excel file
-                    with open(excel_file, "rb") as file:
-                        st.download_button(
-                            label="Download Captions",
-                            data=file,
-                            file_name=excel_file,
-                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            key=f"download_excel_{display_num}"
-                        )
+            show_history_entry(entry, display_num, expanded=(idx == 0))
+
+@st.fragment
+def show_generation_settings():
+    """
+    Display the generation settings in the sidebar.
+
+    Runs as a fragment, so moving a slider reruns only these widgets instead of
+    the whole page. Their values live in session state and are read on Generate.
+    """
+    # Sliders and inputs for settings with tooltips
+    st.slider(
+        "Number of Captions", 
+        min_value=1, 
+        max_value=100, 
+        value=st.session_state.num_captions,
+        key="num_captions",
+        help="Controls how many different captions to generate. Higher values will generate more variations but take longer."
+    )
+    
+    st.select_slider(
+        "Max Tokens", 
+        options=[256, 512, 1024], 
+        value=st.session_state.max_tokens,
+        key="max_tokens",
+        help="Maximum length of the generated caption in tokens. Higher values allow for longer captions but may increase generation time."
+    )
+    
+    st.slider(
+        "Temperature", 
+        min_value=0.0, 
+        max_value=1.5, 
+        value=st.session_state.temperature,
+        step=0.10, 
+        key="temperature",
+        help="Controls randomness in the generation. Higher values (e.g., 1.0) make output more random, lower values (e.g., 0.2) make it more focused and deterministic."
+    )
+    
+    st.slider(
+        "Top-K", 
+        min_value=0, 
+        max_value=100, 
+        value=st.session_state.top_k,
+        step=10, 
+        key="top_k",
+        help="Limits the cumulative probability of tokens considered for generation. Only the top K most likely tokens are considered. Lower values increase focus but may reduce creativity."
+    )
+    
+    st.slider(
+        "Top-P", 
+        min_value=0.0, 
+        max_value=1.0, 
+        value=st.session_state.top_p,
+        step=0.10, 
+        key="top_p",
+        help="Also known as nucleus sampling. Controls diversity by considering tokens whose cumulative probability exceeds P. Lower values (0.1) are more focused, higher values (0.9) are more diverse."
+    )
+
+    st.number_input(
+        "Seed",
+        min_value=0,
+        value=st.session_state.seed,
+        step=1,
+        key="seed",
+        placeholder="Random",
+        help="Optional. With a seed set (or a temperature of 0), the same category, context and settings reproduce the same captions, which are then served from cache instead of calling the model again."
+    )
 
 def main():
     # Initialize session state
@@ -283,99 +656,21 @@ def main():
     # Load CSS file
     load_css("styles.css")
     
-    # Initialize API credentials
-    access_token = initialize_api_credentials()
-
     # Left sidebar for Generation Settings
     with st.sidebar:
         st.header("Generation Settings")
         
         # Add template buttons first
         st.markdown("### Templates")
-        st.markdown("<div style='margin-bottom: 10px;'></div>", unsafe_allow_html=True)
-        
-        col1, col2, col3 = st.columns(3)
-        
-        # Default Template
-        if col1.button("Default"):
-            st.session_state["num_captions"] = 1
-            st.session_state["max_length"] = 1024
-            st.session_state["temperature"] = 0.90
-            st.session_state["top_k"] = 50
-            st.session_state["top_p"] = 0.90
-            st.rerun()
-        
-        # Template 2
-        if col2.button("Template 2"):
-            st.session_state["num_captions"] = 1
-            st.session_state["max_length"] = 1024
-            st.session_state["temperature"] = 1.20
-            st.session_state["top_k"] = 80
-            st.session_state["top_p"] = 0.40
-            st.rerun()
-        
-        # Template 3
-        if col3.button("Template 3"):
-            st.session_state["num_captions"] = 1
-            st.session_state["max_length"] = 1024
-            st.session_state["temperature"] = 1.30
-            st.session_state["top_k"] = 90
-            st.session_state["top_p"] = 0.50
-            st.rerun()
         
-        st.markdown("<div style='margin-bottom: 25px;'></div>", unsafe_allow_html=True)
+        # The settings widgets are created below the buttons, so values set here
+        # are picked up in this run without forcing a rerun
+        columns = st.columns(len(SETTINGS_TEMPLATES))
+        for column, (name, settings) in zip(columns, SETTINGS_TEMPLATES.items()):
+            if column.button(name):
+                st.session_state.update(settings)
         
-        # Sliders and inputs for settings with tooltips
-        st.slider(
-            "Number of Captions", 
-            min_value=1, 
-            max_value=100, 
-            value=st.session_state.num_captions,
-            key="num_captions",
-            help="Controls how many different captions to generate. Higher values will generate more variations but take longer."
-        )
-        st.markdown("<div style='margin-bottom: 15px;'></div>", unsafe_allow_html=True)
-        
-        st.select_slider(
-            "Max Tokens", 
-            options=[256, 512, 1024], 
-            value=st.session_state.max_length,
-            key="max_length",
-            help="Maximum length of the generated caption in tokens. Higher values allow for longer captions but may increase generation time."
-        )
-        st.markdown("<div style='margin-bottom: 15px;'></div>", unsafe_allow_html=True)
-        
-        st.slider(
-            "Temperature", 
-            min_value=0.0, 
-            max_value=1.5, 
-            value=st.session_state.temperature,
-            step=0.10, 
-            key="temperature",
-            help="Controls randomness in the generation. Higher values (e.g., 1.0) make output more random, lower values (e.g., 0.2) make it more focused and deterministic."
-        )
-        st.markdown("<div style='margin-bottom: 15px;'></div>", unsafe_allow_html=True)
-        
-        st.slider(
-            "Top-K", 
-            min_value=0, 
-            max_value=100, 
-            value=st.session_state.top_k,
-            step=10, 
-            key="top_k",
-            help="Limits the cumulative probability of tokens considered for generation. Only the top K most likely tokens are considered. Lower values increase focus but may reduce creativity."
-        )
-        st.markdown("<div style='margin-bottom: 15px;'></div>", unsafe_allow_html=True)
-        
-        st.slider(
-            "Top-P", 
-            min_value=0.0, 
-            max_value=1.0, 
-            value=st.session_state.top_p,
-            step=0.10, 
-            key="top_p",
-            help="Also known as nucleus sampling. Controls diversity by considering tokens whose cumulative probability exceeds P. Lower values (0.1) are more focused, higher values (0.9) are more diverse."
-        )
+        show_generation_settings()
 
         # Add some space before the toggle button
         st.markdown("<br><br>", unsafe_allow_html=True)
@@ -412,8 +707,7 @@ def main():
         # Add Logout button at the bottom
         st.markdown('<div style="position: fixed; bottom: 20px; width: 300px;">', unsafe_allow_html=True)
         if st.button("Logout", use_container_width=True):
-            for key in st.session_state.keys():
-                del st.session_state[key]
+            st.session_state.clear()
             st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
 
@@ -421,7 +715,7 @@ def main():
     if st.session_state.show_history:
         show_history_page()
     else:
-        show_generation_page(access_token)
+        show_generation_page()
 
 # Add this to handle the component value changes
 if 'component_value' in st.session_state:
@@ -435,92 +729,277 @@ if 'component_value' in st.session_state:
         # Handle modal close
         st.session_state.show_history = st.session_state.component_value
 
-def generate_caption_from_api(
+@st.cache_resource
+def get_endpoint_url() -> str:
+    """Build the chat completions URL from the endpoints section of the secrets once"""
+    return f"https://{st.secrets.endpoints.ENDPOINT_DNS}/v1beta1/{st.secrets.endpoints.ENDPOINT_RESOURCE_NAME}/chat/completions"
+
+@st.cache_resource
+def get_max_concurrent_requests() -> int:
+    """Read the endpoint's concurrency limit from the secrets once"""
+    return int(st.secrets.endpoints.get("MAX_CONCURRENT_REQUESTS", MAX_CONCURRENT_REQUESTS))
+
+@st.cache_resource
+def get_captions_per_request() -> int:
+    """Read how many captions to sample per request from the secrets once"""
+    return max(1, int(st.secrets.endpoints.get("CAPTIONS_PER_REQUEST", CAPTIONS_PER_REQUEST)))
+
+def build_request_headers(access_token: str) -> dict:
+    """Build the headers shared by every caption request in a generation run"""
+    return {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+
+def build_request_body(
     instruction: str,
     input_text: str,
-    max_length: int,
+    max_tokens: int,
     temperature: float,
-    top_k: int,
     top_p: float,
-    access_token: str
-) -> str:
+    n: int = 1,
+    seed: Optional[int] = None
+) -> bytes:
     """
-    Generate caption using API call to Vertex AI.
+    Serialize the chat completion request shared by every caption in a generation run.
     
     Args:
         instruction: The instruction for caption generation
         input_text: The context for caption generation
-        max_length: Maximum length of generated text
+        max_tokens: Maximum number of tokens to generate, excluding the prompt
         temperature: Temperature for text generation
-        top_k: Top-k parameter for sampling
         top_p: Top-p parameter for sampling
-        access_token: Authentication token for API access
+        n: Number of captions to sample in the one request
+        seed: Optional sampling seed for reproducible output
     
     Returns:
-        str: Generated caption text
+        bytes: JSON request body
+    """
+    payload = {
+        "messages": [{"role": "user", "content": ALPACA_PROMPT.format(instruction=instruction, input_text=input_text)}],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        "stream": True,
+    }
+    if n > 1:
+        payload["n"] = n
+    if seed is not None:
+        payload["seed"] = seed
+    return orjson.dumps(payload)
+
+def make_request_bodies(settings: tuple, seed: Optional[int] = None, stride: int = 0):
+    """
+    Return `make_body(n, attempt)`, which builds the request body for `n` captions.
+
+    Unseeded bodies are identical on every attempt, so each size is serialized once.
+    Seeded bodies step the seed by `stride` (the number of captions in the run) on each
+    attempt, so a retry never reuses a seed that belongs to another batch in the run.
+    """
+    @functools.lru_cache(maxsize=None)
+    def body(n, body_seed):
+        return build_request_body(*settings, n=n, seed=body_seed)
+
+    def make_body(n, attempt):
+        return body(n, None if seed is None else seed + attempt * stride)
+
+    return make_body
+
+def stream_caption_from_api(
+    session: "requests.Session", url: str, body: bytes, headers: dict
+) -> Iterator[tuple[int, str]]:
+    """
+    Stream generated captions from Vertex AI as they are produced.
+    
+    Args:
+        session: Pooled HTTP session from get_http_session
+        url: Endpoint URL from get_endpoint_url
+        body: Request body from build_request_body
+        headers: Request headers from build_request_headers
+    
+    Yields:
+        tuple[int, str]: Choice index and the next piece of that caption's text
     
     Raises:
         ValueError: If API request fails or returns error
+        TimeoutError: If the stream runs longer than STREAM_DEADLINE
     """
-    # Alpaca prompt template
-    alpaca_prompt = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+    deadline = time.monotonic() + STREAM_DEADLINE
 
-    ### Instruction:
-    {}
+    # Send the POST request to the API
+    # Closing the response returns its connection to the session pool
+    with session.post(
+        url, headers=headers, data=body, stream=True, timeout=REQUEST_TIMEOUT
+    ) as response:
+        if not response.ok:
+            raise ValueError(response.text)
 
-    ### Input:
-    {}
+        for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Caption stream exceeded {STREAM_DEADLINE} seconds")
+            if chunk:
+                # Frame on the raw bytes; orjson parses UTF-8 directly
+                chunk = chunk.removeprefix(b"data:").strip()
+                if chunk == b"[DONE]":
+                    break
+                # Role headers, finish events and keep-alives carry no text; skip them
+                # unparsed, but still parse anything that may report an error
+                if b'"content"' not in chunk and b'"error"' not in chunk:
+                    continue
+                data = orjson.loads(chunk)
+                try:
+                    choices = data["choices"]
+                except (KeyError, TypeError):
+                    # Only frames without choices pay for the error lookup
+                    if isinstance(data, dict) and "error" in data:
+                        raise ValueError(data["error"]) from None
+                    raise ValueError(data) from None
+                for choice in choices:
+                    delta = choice["delta"].get("content")
+                    if delta:
+                        yield choice.get("index", 0), delta
 
-    ### Response:
-    {}"""
+def contains_banned_words(text: str, banned_words_list: list[str]) -> bool:
+    """Check whether any banned word appears as a word in the text"""
+    words_in_text = text.lower().split()
+    return any(banned_word in words_in_text for banned_word in banned_words_list)
 
-    # Define the endpoint URL using the endpoints section
-    url = f"https://{st.secrets.endpoints.ENDPOINT_DNS}/v1beta1/{st.secrets.endpoints.ENDPOINT_RESOURCE_NAME}/chat/completions"
+def generate_valid_captions(
+    session: "requests.Session",
+    url: str,
+    make_body,
+    num_captions: int,
+    headers: dict,
+    banned_words_list: list[str],
+    on_delta=None,
+    max_attempts: int = MAX_CAPTION_ATTEMPTS,
+    stop: Optional[threading.Event] = None
+) -> list[tuple[Optional[str], int]]:
+    """
+    Generate a batch of captions, retrying until none contains banned words.
 
-    payload = {
-        "messages": [{"role": "user", "content": alpaca_prompt.format(instruction, input_text, "")}],
-        "max_tokens": max_length,
-        "temperature": temperature,
-        "top_p": top_p,
-        "stream": True,
-    }
+    The first attempt samples all `num_captions` in one request built by
+    `make_body(n, attempt)`; later attempts request only the captions that were
+    rejected, up to `max_attempts` requests in all. `on_delta(slot, delta)` is
+    called with each streamed piece of text, and with None when a rejected caption
+    is discarded. Once `stop` is set, CancelledError is raised before the next
+    attempt or at the next delta, which closes the response being streamed.
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    Returns:
+        list[tuple[Optional[str], int]]: Each valid caption, or None if every attempt
+        was rejected, and its number of rejected attempts
+    """
+    captions = [None] * num_captions
+    rejected = [0] * num_captions
+    pending = list(range(num_captions))
 
-    # Send the POST request to the API
-    response = requests.post(
-        url, headers={"Authorization": f"Bearer {access_token}"}, json=payload, stream=True
-    )
-    
-    if not response.ok:
-        raise ValueError(response.text)
-
-    result = []  # List to accumulate the chunks
-    for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False):
-        if chunk:
-            chunk = chunk.decode("utf-8").removeprefix("data:").strip()
-            if chunk == "[DONE]":
-                break
-            data = json.loads(chunk)
-            if type(data) is not dict or "error" in data:
-                raise ValueError(data)
-            delta = data["choices"][0]["delta"].get("content")
-            if delta:
-                result.append(delta)  # Accumulate the chunks
-    full_result = ''.join(result)
-    return full_result
+    for attempt in range(max_attempts):
+        if stop is not None and stop.is_set():
+            raise CancelledError
+        results = [io.StringIO() for _ in pending]  # Buffers to accumulate the chunks
+        for choice, delta in stream_caption_from_api(session, url, make_body(len(pending), attempt), headers):
+            if stop is not None and stop.is_set():
+                raise CancelledError
+            results[choice].write(delta)
+            if on_delta:
+                on_delta(pending[choice], delta)
+
+        still_pending = []
+        for slot, result in zip(pending, results):
+            response = result.getvalue()
+            if response and not contains_banned_words(response, banned_words_list):
+                captions[slot] = response
+                continue
+            if response:
+                rejected[slot] += 1
+            if on_delta:
+                on_delta(slot, None)
+            still_pending.append(slot)
+
+        pending = still_pending
+        if not pending:
+            break
+    return list(zip(captions, rejected))
+
+def generate_captions_concurrently(
+    jobs: list[tuple[list[int], Callable[[int, int], bytes]]],
+    on_delta,
+    on_caption,
+    on_idle,
+    session: "requests.Session",
+    url: str,
+    headers: dict,
+    banned_words_list: list[str],
+    max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS,
+    max_attempts: int = MAX_CAPTION_ATTEMPTS
+) -> None:
+    """
+    Generate every batch of captions in `jobs` concurrently.
+
+    Each job is a list of caption indices and the `make_body` used to request them.
+    Jobs run through `generate_valid_captions` in worker threads, with at most
+    `max_concurrent_requests` requests in flight at once. Workers never touch
+    Streamlit; their updates are queued and both callbacks run on the calling
+    thread: `on_delta(idx, delta)` for every streamed piece of text, and
+    `on_caption(idx, caption, rejected)` as each caption completes, with caption
+    None if no attempt out of `max_attempts` was free of banned words.
+
+    `on_idle()` runs on the calling thread whenever no update arrives for
+    RENDER_INTERVAL. Streamlit only interrupts a script at a Streamlit call, so it
+    should make a cheap one; that lets Stop or a rerun take effect while workers
+    wait on the endpoint. If this returns early, because of an error or an
+    interrupted run, queued batches are cancelled and running workers stop before
+    their next attempt or at their next delta. A worker blocked in a read holds
+    its connection until data arrives or the REQUEST_TIMEOUT read timeout expires.
+    """
+    updates = queue.SimpleQueue()
+    stop = threading.Event()
+
+    def emitter(slots):
+        return lambda slot, delta: updates.put((slots[slot], delta))
+
+    pool = ThreadPoolExecutor(max_workers=min(len(jobs), max_concurrent_requests))
+    try:
+        futures = {}
+        for slots, make_body in jobs:
+            future = pool.submit(
+                generate_valid_captions,
+                session, url, make_body, len(slots), headers, banned_words_list, emitter(slots),
+                max_attempts, stop,
+            )
+            futures[future] = slots
+            # Completion is queued behind the batch's own deltas, so it is handled last
+            future.add_done_callback(updates.put)
+
+        remaining = len(futures)
+        while remaining:
+            try:
+                update = updates.get(timeout=RENDER_INTERVAL)
+            except queue.Empty:
+                on_idle()
+                continue
+            if isinstance(update, Future):
+                for idx, (caption, rejected) in zip(futures[update], update.result()):
+                    on_caption(idx, caption, rejected)
+                remaining -= 1
+            else:
+                on_delta(*update)
+    finally:
+        # If the run ends early (an error, Stop, or a rerun interrupting the script),
+        # signal the workers and drop queued batches instead of waiting for them
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
 
 def validate_inputs(instruction: str, input_text: str) -> tuple[bool, str]:
     """Validate user inputs before generation"""
-    if not instruction.strip():
-        return False, "Instruction cannot be empty"
-    if not input_text.strip():
-        return False, "Context cannot be empty"
+    # Length is O(1), so reject oversized context before scanning any text
     if len(input_text) > 1000:  # Example limit
         return False, "Context is too long (max 1000 characters)"
+    # isspace() stops at the first visible character instead of copying like strip()
+    if not instruction or instruction.isspace():
+        return False, "Instruction cannot be empty"
+    if not input_text or input_text.isspace():
+        return False, "Context cannot be empty"
     return True, ""
 
 def access_banned_words_list():